@@ -1,14 +1,52 @@
-import json
+import argparse
+import asyncio
+import hashlib
 import time
 from datetime import datetime, timezone
 from pathlib import Path
-from typing import Any, Dict, List, Optional
+from typing import Any, Dict, List, Optional, Set
 
-import requests
+import httpx
+import orjson
+import pyarrow as pa
+import pyarrow.parquet as pq
+import zstandard
+from aiolimiter import AsyncLimiter
 
 
 GAMMA_BASE = "https://gamma-api.polymarket.com"   # Gamma Markets API :contentReference[oaicite:1]{index=1}
 CLOB_BASE = "https://clob.polymarket.com"         # CLOB API :contentReference[oaicite:2]{index=2}
+USER_AGENT = "polymarket-radar/0.1"
+
+GAMMA_RATE_PER_S = 2
+CLOB_RATE_PER_S = 5                              # compartido por books + prices-history
+
+RETRY_TOTAL = 3
+RETRY_BACKOFF_S = 0.5                            # 0.5s, 1s, 2s
+RETRY_STATUS = {429, 502, 503, 504}
+RETRY_AFTER_MAX_S = 30
+
+GAMMA_LIMITER = AsyncLimiter(GAMMA_RATE_PER_S, 1)
+CLOB_LIMITER = AsyncLimiter(CLOB_RATE_PER_S, 1)
+
+CACHE_DIR = Path("data/cache/gamma")
+MARKETS_CACHE_TTL_S = 300                        # stale-while-revalidate a partir de TTL/2
+
+# refrescos de caché lanzados en segundo plano (se esperan antes de cerrar el cliente)
+BACKGROUND_TASKS: Set[asyncio.Task] = set()
+
+# orderbooks aplanados: una fila por nivel (level = posición en la respuesta de la API).
+# book_idx = posición del book en la respuesta; un book sin niveles válidos deja
+# una fila con side/level/price/size a null para no perderlo.
+BOOKS_SCHEMA = pa.schema([
+    ("book_idx", pa.int32()),
+    ("snapshot_ts", pa.string()),
+    ("token_id", pa.string()),
+    ("side", pa.string()),
+    ("level", pa.int32()),
+    ("price", pa.float64()),
+    ("size", pa.float64()),
+])
 
 
 def utc_now_tag() -> str:
@@ -19,35 +57,127 @@ def chunked(items: List[Any], size: int) -> List[List[Any]]:
     return [items[i:i + size] for i in range(0, len(items), size)]
 
 
-def safe_json_loads(x: Any) -> Any:
-    if isinstance(x, str):
-        try:
-            return json.loads(x)
-        except Exception:
-            return x
-    return x
+def make_client() -> httpx.AsyncClient:
+    """
+    Cliente HTTP/2 compartido: las requests concurrentes se multiplexan sobre
+    la misma conexión (un solo handshake TLS por host). httpx ya pide gzip
+    (y br si está instalado brotli); el transport reintenta fallos de conexión.
+    """
+    transport = httpx.AsyncHTTPTransport(
+        http2=True,
+        retries=RETRY_TOTAL,
+        limits=httpx.Limits(max_keepalive_connections=16),
+    )
+    return httpx.AsyncClient(
+        transport=transport,
+        timeout=30,
+        headers={"User-Agent": USER_AGENT},
+    )
+
+
+def retry_delay_s(r: httpx.Response, attempt: int) -> float:
+    # Retry-After en segundos si viene; si no (o es una fecha), backoff exponencial
+    try:
+        return min(float(r.headers["Retry-After"]), RETRY_AFTER_MAX_S)
+    except (KeyError, ValueError):
+        return RETRY_BACKOFF_S * (2 ** attempt)
+
+
+async def send_with_retry(
+    client: httpx.AsyncClient, limiter: AsyncLimiter, method: str, url: str, **kwargs: Any,
+) -> httpx.Response:
+    """
+    Lanza la request respetando el limiter y reintenta 429/5xx, esperando lo que
+    diga Retry-After (o con backoff exponencial). Cada intento gasta un hueco del limiter.
+    Devuelve la última respuesta (el caller hace raise_for_status()).
+    """
+    for attempt in range(RETRY_TOTAL + 1):
+        async with limiter:
+            r = await client.request(method, url, **kwargs)
+        if r.status_code not in RETRY_STATUS or attempt == RETRY_TOTAL:
+            break
+        await asyncio.sleep(retry_delay_s(r, attempt))
+    return r
 
 
-def fetch_markets(limit: int = 200, offset: int = 0) -> List[Dict[str, Any]]:
+def parse_clob_token_ids(x: Any) -> List[str]:
     """
-    Gamma: GET /markets (soporta limit/offset/order/ascending/closed, etc.). :contentReference[oaicite:3]{index=3}
+    clobTokenIds llega como lista o como string JSON '["...", "..."]';
+    cualquier otra cosa (o un string no parseable) se trata como [].
     """
-    url = f"{GAMMA_BASE}/markets"
-    params = {
+    if isinstance(x, list):
+        return [str(t) for t in x]
+    if isinstance(x, str) and x.startswith("["):
+        try:
+            return [str(t) for t in orjson.loads(x)]
+        except orjson.JSONDecodeError:
+            return []
+    return []
+
+
+def markets_params(limit: int, offset: int) -> Dict[str, Any]:
+    return {
         "limit": limit,
         "offset": offset,
         "order": "volumeNum",   # ordenar por volumen numérico
         "ascending": "false",
         "closed": "false",      # query param documentado :contentReference[oaicite:4]{index=4}
     }
-    r = requests.get(url, params=params, timeout=30)
+
+
+async def fetch_markets(client: httpx.AsyncClient, limit: int = 200, offset: int = 0) -> List[Dict[str, Any]]:
+    """
+    Gamma: GET /markets (soporta limit/offset/order/ascending/closed, etc.). :contentReference[oaicite:3]{index=3}
+    """
+    url = f"{GAMMA_BASE}/markets"
+    r = await send_with_retry(client, GAMMA_LIMITER, "GET", url, params=markets_params(limit, offset))
     r.raise_for_status()
-    data = r.json()
+    data = orjson.loads(r.content)
     if not isinstance(data, list):
         raise ValueError("Respuesta inesperada de Gamma /markets (se esperaba lista).")
     return data
 
 
+async def refresh_markets_cache(client: httpx.AsyncClient, limit: int, offset: int, path: Path) -> List[Dict[str, Any]]:
+    data = await fetch_markets(client, limit=limit, offset=offset)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_suffix(".tmp")
+    tmp.write_bytes(orjson.dumps(data))
+    tmp.replace(path)  # escritura atómica: nunca se lee un fichero a medias
+    return data
+
+
+async def refresh_markets_cache_quiet(client: httpx.AsyncClient, limit: int, offset: int, path: Path) -> None:
+    try:
+        await refresh_markets_cache(client, limit, offset, path)
+    except Exception as e:
+        print(f"[WARN] refresco en segundo plano de Gamma /markets falló: {e}")
+
+
+async def fetch_markets_cached(
+    client: httpx.AsyncClient, limit: int = 200, offset: int = 0, ttl_s: float = MARKETS_CACHE_TTL_S,
+) -> List[Dict[str, Any]]:
+    """
+    fetch_markets con caché en disco (stale-while-revalidate), clave = params de la query:
+      - edad < TTL/2:        se sirve la copia en disco
+      - TTL/2 <= edad < TTL: se sirve la copia y se refresca en segundo plano
+      - edad >= TTL o sin copia: se descarga, se guarda y se devuelve
+    """
+    key = hashlib.sha1(repr(markets_params(limit, offset)).encode()).hexdigest()
+    path = CACHE_DIR / f"markets_{key}.json"
+
+    if path.exists():
+        age_s = time.time() - path.stat().st_mtime
+        if age_s < ttl_s:
+            if age_s >= ttl_s / 2:
+                task = asyncio.create_task(refresh_markets_cache_quiet(client, limit, offset, path))
+                BACKGROUND_TASKS.add(task)
+                task.add_done_callback(BACKGROUND_TASKS.discard)
+            return orjson.loads(path.read_bytes())
+
+    return await refresh_markets_cache(client, limit, offset, path)
+
+
 def pick_top_markets(raw_markets: List[Dict[str, Any]], top_n: int = 100) -> List[Dict[str, Any]]:
     """
     Filtra y normaliza mercados que tengan enableOrderBook=true (CLOB-tradeable). :contentReference[oaicite:5]{index=5}
@@ -62,15 +192,7 @@ def pick_top_markets(raw_markets: List[Dict[str, Any]], top_n: int = 100) -> Lis
         if m.get("active") is not True:
             continue
 
-        clob_token_ids = safe_json_loads(m.get("clobTokenIds"))
-        if isinstance(clob_token_ids, str):
-            # a veces viene como string no parseable; intenta separar manualmente
-            # (lo dejamos como lista vacía si no es usable)
-            clob_token_ids_list: List[str] = []
-        elif isinstance(clob_token_ids, list):
-            clob_token_ids_list = [str(x) for x in clob_token_ids]
-        else:
-            clob_token_ids_list = []
+        clob_token_ids_list = parse_clob_token_ids(m.get("clobTokenIds"))
 
         if len(clob_token_ids_list) == 0:
             continue
@@ -101,27 +223,46 @@ def pick_top_markets(raw_markets: List[Dict[str, Any]], top_n: int = 100) -> Lis
     return cleaned[:top_n]
 
 
-def fetch_orderbooks_bulk(token_ids: List[str], batch_size: int = 50, sleep_s: float = 0.2) -> List[Dict[str, Any]]:
+async def fetch_books_batch(client: httpx.AsyncClient, batch: List[str]) -> List[Dict[str, Any]]:
     """
     CLOB: POST /books (varios token_id por request). :contentReference[oaicite:6]{index=6}
     """
     url = f"{CLOB_BASE}/books"
+    payload = [{"token_id": tid} for tid in batch]
+    r = await send_with_retry(
+        client, CLOB_LIMITER, "POST", url,
+        content=orjson.dumps(payload), headers={"Content-Type": "application/json"},
+    )
+    r.raise_for_status()
+    data = orjson.loads(r.content)
+    if isinstance(data, list):
+        return data
+    # por si viene como objeto
+    return [data]
+
+
+async def fetch_orderbooks_bulk(client: httpx.AsyncClient, token_ids: List[str], batch_size: int = 50) -> List[Dict[str, Any]]:
+    """
+    Lanza todos los batches de /books a la vez (el limiter marca el ritmo).
+    Un batch que falla se avisa y se salta: el snapshot se queda con los que
+    llegaron. Solo se aborta si fallan todos.
+    """
+    batches = chunked(token_ids, batch_size)
+    results = await asyncio.gather(*(fetch_books_batch(client, b) for b in batches), return_exceptions=True)
     out: List[Dict[str, Any]] = []
-    for batch in chunked(token_ids, batch_size):
-        payload = [{"token_id": tid} for tid in batch]
-        r = requests.post(url, json=payload, timeout=30)
-        r.raise_for_status()
-        data = r.json()
-        if isinstance(data, list):
-            out.extend(data)
-        else:
-            # por si viene como objeto
-            out.append(data)
-        time.sleep(sleep_s)
+    failed = 0
+    for i, data in enumerate(results):
+        if isinstance(data, Exception):
+            failed += 1
+            print(f"[WARN] /books falló para el batch {i} ({len(batches[i])} tokens): {data}")
+            continue
+        out.extend(data)
+    if batches and failed == len(batches):
+        raise RuntimeError("Todos los batches de /books fallaron.")
     return out
 
 
-def fetch_price_history(token_id: str, interval: str = "1w", fidelity_min: int = 15) -> Dict[str, Any]:
+async def fetch_price_history(client: httpx.AsyncClient, token_id: str, interval: str = "1w", fidelity_min: int = 15) -> Dict[str, Any]:
     """
     CLOB: GET /prices-history con params market=<token_id>, interval, fidelity. :contentReference[oaicite:7]{index=7}
     """
@@ -131,12 +272,119 @@ def fetch_price_history(token_id: str, interval: str = "1w", fidelity_min: int =
         "interval": interval,
         "fidelity": fidelity_min,
     }
-    r = requests.get(url, params=params, timeout=30)
+    r = await send_with_retry(client, CLOB_LIMITER, "GET", url, params=params)
     r.raise_for_status()
-    return r.json()
+    return orjson.loads(r.content)
 
 
-def main():
+async def fetch_price_history_batch(
+    client: httpx.AsyncClient, token_ids: List[str], interval: str = "1w", fidelity_min: int = 15,
+) -> Optional[Dict[str, Any]]:
+    """
+    Intenta bajar el history de todos los tokens en una sola request
+    (POST /prices-history con una lista, al estilo de POST /books).
+    Devuelve None si el endpoint no acepta batch o la respuesta no encaja.
+    Es una sonda: un solo intento sin reintentos, para que un endpoint que no
+    existe cueste un hueco del limiter y no retrase el fallback por token.
+    """
+    url = f"{CLOB_BASE}/prices-history"
+    payload = [{"market": tid, "interval": interval, "fidelity": fidelity_min} for tid in token_ids]
+    try:
+        async with CLOB_LIMITER:
+            r = await client.request(
+                "POST", url,
+                content=orjson.dumps(payload), headers={"Content-Type": "application/json"},
+            )
+    except httpx.HTTPError:
+        return None
+    if not r.is_success:
+        return None
+    if "json" not in r.headers.get("Content-Type", ""):
+        return None
+    try:
+        data = orjson.loads(r.content)
+    except orjson.JSONDecodeError:
+        return None
+    # lista en el mismo orden que el payload, o dict por token
+    if isinstance(data, list) and len(data) == len(token_ids):
+        return dict(zip(token_ids, data))
+    if isinstance(data, dict) and all(tid in data for tid in token_ids):
+        return {tid: data[tid] for tid in token_ids}
+    return None
+
+
+async def fetch_price_history_all(
+    client: httpx.AsyncClient, token_ids: List[str], interval: str = "1w", fidelity_min: int = 15,
+) -> Dict[str, Any]:
+    """
+    History por token (dict token_id -> respuesta, o la excepción si falló).
+    Primero prueba el batch; si no hay, una request por token multiplexadas
+    sobre la misma conexión HTTP/2.
+    """
+    batched = await fetch_price_history_batch(client, token_ids, interval, fidelity_min)
+    if batched is not None:
+        return batched
+
+    results = await asyncio.gather(
+        *(fetch_price_history(client, tid, interval, fidelity_min) for tid in token_ids),
+        return_exceptions=True,
+    )
+    return dict(zip(token_ids, results))
+
+
+def books_to_table(books: List[Dict[str, Any]]) -> pa.Table:
+    """
+    Aplana los books de /books a BOOKS_SCHEMA (los niveles mal formados se descartan;
+    si no queda ninguno, el book deja su fila vacía).
+    """
+    cols: Dict[str, list] = {name: [] for name in BOOKS_SCHEMA.names}
+
+    def add_row(book_idx, snap_ts, token_id, side, level, price, size) -> None:
+        cols["book_idx"].append(book_idx)
+        cols["snapshot_ts"].append(snap_ts)
+        cols["token_id"].append(token_id)
+        cols["side"].append(side)
+        cols["level"].append(level)
+        cols["price"].append(price)
+        cols["size"].append(size)
+
+    for book_idx, ob in enumerate(books):
+        token_id = str(ob.get("asset_id") or ob.get("token_id") or "")
+        snap_ts = str(ob.get("timestamp") or "")
+        n_levels = 0
+        for side, key in (("bid", "bids"), ("ask", "asks")):
+            for level, x in enumerate(ob.get(key) or [], start=1):
+                try:
+                    price = float(x["price"])
+                    size = float(x["size"])
+                except Exception:
+                    continue
+                add_row(book_idx, snap_ts, token_id, side, level, price, size)
+                n_levels += 1
+        if n_levels == 0:
+            add_row(book_idx, snap_ts, token_id, None, None, None, None)
+    return pa.table(cols, schema=BOOKS_SCHEMA)
+
+
+def write_books_parquet(path: Path, books: List[Dict[str, Any]]) -> None:
+    # token_id/side se repiten en cada nivel: con diccionario quedan en un int por fila
+    pq.write_table(
+        books_to_table(books), path,
+        compression="zstd",
+        use_dictionary=["snapshot_ts", "token_id", "side"],
+    )
+
+
+def write_history_shard(path: Path, history: Dict[str, Any]) -> None:
+    """
+    Un único NDJSON comprimido con zstd: una línea {"token_id", "data"} por token.
+    """
+    with path.open("wb") as f, zstandard.ZstdCompressor(level=3).stream_writer(f) as w:
+        for tid, h in history.items():
+            w.write(orjson.dumps({"token_id": tid, "data": h}) + b"\n")
+
+
+async def amain(raw_books: bool = False, pretty: bool = False, history_layout: str = "shard"):
     TOP_MARKETS = 100
     HISTORY_TOP_MARKETS = 20      # para no bajar demasiado al inicio
     HISTORY_INTERVAL = "1w"
@@ -147,44 +395,73 @@ def main():
     base = Path("data/bronze/polymarket") / tag
     (base / "markets").mkdir(parents=True, exist_ok=True)
     (base / "books").mkdir(parents=True, exist_ok=True)
-    (base / "prices_history").mkdir(parents=True, exist_ok=True)
-
-    # 1) Markets (Gamma)
-    raw = fetch_markets(limit=300, offset=0)
-    markets = pick_top_markets(raw, top_n=TOP_MARKETS)
-
-    (base / "markets" / "markets_top.json").write_text(json.dumps(markets, ensure_ascii=False, indent=2), encoding="utf-8")
-    print(f"[OK] Markets guardados: {base / 'markets' / 'markets_top.json'}  (n={len(markets)})")
-
-    # 2) Token IDs
-    token_ids: List[str] = []
-    for m in markets:
-        token_ids.extend(m["clobTokenIds"])
-    token_ids = sorted(set(token_ids))
-    print(f"[INFO] Tokens únicos: {len(token_ids)}")
-
-    # 3) Orderbooks bulk (CLOB)
-    books = fetch_orderbooks_bulk(token_ids, batch_size=50)
-    (base / "books" / "orderbooks.json").write_text(json.dumps(books, ensure_ascii=False), encoding="utf-8")
-    print(f"[OK] Orderbooks guardados: {base / 'books' / 'orderbooks.json'}  (n={len(books)})")
-
-    # 4) Price history (solo top 20 mercados para arrancar)
-    hist_tokens: List[str] = []
-    for m in markets[:HISTORY_TOP_MARKETS]:
-        hist_tokens.extend(m["clobTokenIds"])
-    hist_tokens = sorted(set(hist_tokens))
-
-    for tid in hist_tokens:
-        try:
-            h = fetch_price_history(tid, interval=HISTORY_INTERVAL, fidelity_min=HISTORY_FIDELITY_MIN)
-            (base / "prices_history" / f"{tid}.json").write_text(json.dumps(h, ensure_ascii=False), encoding="utf-8")
-            time.sleep(0.15)
-        except Exception as e:
-            print(f"[WARN] prices-history falló para token {tid}: {e}")
 
-    print(f"[OK] Price history guardado en: {base / 'prices_history'}  (tokens={len(hist_tokens)})")
+    async with make_client() as client:
+        # 1) Markets (Gamma)
+        raw = await fetch_markets_cached(client, limit=300, offset=0)
+        markets = pick_top_markets(raw, top_n=TOP_MARKETS)
+
+        # compacto por defecto (es un artefacto de archivo); --pretty para leerlo a mano
+        json_opt = orjson.OPT_INDENT_2 if pretty else 0
+        (base / "markets" / "markets_top.json").write_bytes(orjson.dumps(markets, option=json_opt))
+        print(f"[OK] Markets guardados: {base / 'markets' / 'markets_top.json'}  (n={len(markets)})")
+
+        # 2) Token IDs (sin duplicados, en orden de volumen: los primeros batches
+        #    de /books llevan los mercados más importantes)
+        token_ids: List[str] = list(dict.fromkeys(tid for m in markets for tid in m["clobTokenIds"]))
+        print(f"[INFO] Tokens únicos: {len(token_ids)}")
+
+        # 3) Orderbooks bulk (CLOB)
+        books = await fetch_orderbooks_bulk(client, token_ids, batch_size=50)
+        write_books_parquet(base / "books" / "orderbooks.parquet", books)
+        print(f"[OK] Orderbooks guardados: {base / 'books' / 'orderbooks.parquet'}  (n={len(books)})")
+        if raw_books:
+            # JSON tal cual de la API, para poder reprocesar/replay
+            (base / "books" / "orderbooks.json").write_bytes(orjson.dumps(books))
+            print(f"[OK] Orderbooks (raw) guardados: {base / 'books' / 'orderbooks.json'}")
+
+        # 4) Price history (solo top 20 mercados para arrancar)
+        hist_tokens: List[str] = list(dict.fromkeys(
+            tid for m in markets[:HISTORY_TOP_MARKETS] for tid in m["clobTokenIds"]
+        ))
+
+        history = await fetch_price_history_all(client, hist_tokens, HISTORY_INTERVAL, HISTORY_FIDELITY_MIN)
+
+        # no cerrar el cliente con refrescos de caché a medias
+        if BACKGROUND_TASKS:
+            await asyncio.gather(*BACKGROUND_TASKS)
+
+    history_ok: Dict[str, Any] = {}
+    for tid, h in history.items():
+        if isinstance(h, Exception):
+            print(f"[WARN] prices-history falló para token {tid}: {h}")
+            continue
+        history_ok[tid] = h
+
+    if history_layout == "files":
+        history_out = base / "prices_history"
+        history_out.mkdir(parents=True, exist_ok=True)
+        for tid, h in history_ok.items():
+            (history_out / f"{tid}.json").write_bytes(orjson.dumps(h))
+    else:
+        history_out = base / "prices_history.jsonl.zst"
+        write_history_shard(history_out, history_ok)
+
+    print(f"[OK] Price history guardado en: {history_out}  (tokens={len(hist_tokens)})")
     print("[DONE] Snapshot completado.")
 
 
+def main():
+    parser = argparse.ArgumentParser(description="Snapshot de Polymarket (markets, orderbooks, price history) a bronze.")
+    parser.add_argument("--raw", action="store_true", help="guardar también orderbooks.json tal cual de la API")
+    parser.add_argument("--pretty", action="store_true", help="JSON indentado (legible) en vez de compacto")
+    parser.add_argument(
+        "--history-layout", choices=["shard", "files"], default="shard",
+        help="shard: prices_history.jsonl.zst | files: un prices_history/<token>.json por token (layout antiguo)",
+    )
+    args = parser.parse_args()
+    asyncio.run(amain(raw_books=args.raw, pretty=args.pretty, history_layout=args.history_layout))
+
+
 if __name__ == "__main__":
     main()
@@ -1,34 +1,127 @@
-import json
+import argparse
+import threading
 import time
 from datetime import datetime, timezone
 from pathlib import Path
 from typing import Any, Dict, List
 
+import orjson
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util import Retry, make_headers
 
 GAMMA_BASE = "https://gamma-api.polymarket.com"
 CLOB_BASE = "https://clob.polymarket.com"
+USER_AGENT = "polymarket-radar/0.1"
 
 TOP_MARKETS = 100
 BOOKS_BATCH = 50
-SLEEP_BETWEEN_POSTS = 0.25
+GAMMA_RATE_PER_S = 2
+CLOB_RATE_PER_S = 4
+
+RETRY_TOTAL = 3
+RETRY_BACKOFF_S = 0.5                            # 0.5s, 1s, 2s
+RETRY_STATUS = {429, 502, 503, 504}
+RETRY_AFTER_MAX_S = 30
 
 OUT_DIR = Path("data/bronze/polymarket_stream")
 TOKENS_FILE = OUT_DIR / "tokens_top.json"
 MARKETS_FILE = OUT_DIR / "markets_top.json"
 
 
+class TokenBucket:
+    """
+    Rate limiter tipo token bucket: como mucho `rate` llamadas cada `per` segundos.
+    Es thread-safe, así que sirve igual con un solo hilo que con un pool.
+    """
+
+    def __init__(self, rate: float, per: float = 1.0):
+        self.capacity = float(rate)
+        self.fill_rate = rate / per
+        self.tokens = float(rate)
+        self.last = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self) -> None:
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.last) * self.fill_rate)
+                self.last = now
+                if self.tokens >= 1.0:
+                    self.tokens -= 1.0
+                    return
+                wait_s = (1.0 - self.tokens) / self.fill_rate
+            time.sleep(wait_s)
+
+
+GAMMA_BUCKET = TokenBucket(GAMMA_RATE_PER_S)
+CLOB_BUCKET = TokenBucket(CLOB_RATE_PER_S)
+
+
+def make_session() -> requests.Session:
+    """
+    Sesión compartida para todas las llamadas a Polymarket:
+      - keep-alive + pool de conexiones (sin handshake TCP/TLS por request)
+      - respuestas comprimidas (gzip, y br si está instalado brotli)
+      - el adapter solo reintenta fallos de conexión; los 429/5xx se reintentan
+        en send_with_retry() para que cada intento pase por el bucket
+    """
+    session = requests.Session()
+    session.headers.update(make_headers(accept_encoding=True, user_agent=USER_AGENT))
+    retry = Retry(
+        total=RETRY_TOTAL,
+        status=0,
+        backoff_factor=RETRY_BACKOFF_S,
+        allowed_methods=["GET", "POST"],
+        respect_retry_after_header=False,   # si no, un 429 con Retry-After acaba en RetryError
+        raise_on_status=False,
+    )
+    adapter = HTTPAdapter(pool_connections=16, pool_maxsize=16, max_retries=retry)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+SESSION = make_session()
+
+
+def retry_delay_s(r: requests.Response, attempt: int) -> float:
+    # Retry-After en segundos si viene; si no (o es una fecha), backoff exponencial
+    try:
+        return min(float(r.headers["Retry-After"]), RETRY_AFTER_MAX_S)
+    except (KeyError, ValueError):
+        return RETRY_BACKOFF_S * (2 ** attempt)
+
+
+def send_with_retry(bucket: TokenBucket, method: str, url: str, **kwargs: Any) -> requests.Response:
+    # versión síncrona de send_with_retry() de polymarket_snapshot.py
+    for attempt in range(RETRY_TOTAL + 1):
+        bucket.acquire()
+        r = SESSION.request(method, url, **kwargs)
+        if r.status_code not in RETRY_STATUS or attempt == RETRY_TOTAL:
+            break
+        time.sleep(retry_delay_s(r, attempt))
+    return r
+
+
 def utc_iso() -> str:
     return datetime.now(timezone.utc).isoformat()
 
 
-def safe_json_loads(x: Any) -> Any:
-    if isinstance(x, str):
+def parse_clob_token_ids(x: Any) -> List[str]:
+    """
+    clobTokenIds llega como lista o como string JSON '["...", "..."]';
+    cualquier otra cosa (o un string no parseable) se trata como [].
+    """
+    if isinstance(x, list):
+        return [str(t) for t in x]
+    if isinstance(x, str) and x.startswith("["):
         try:
-            return json.loads(x)
-        except Exception:
-            return x
-    return x
+            return [str(t) for t in orjson.loads(x)]
+        except orjson.JSONDecodeError:
+            return []
+    return []
 
 
 def fetch_markets(limit: int = 300, offset: int = 0) -> List[Dict[str, Any]]:
@@ -40,9 +133,9 @@ def fetch_markets(limit: int = 300, offset: int = 0) -> List[Dict[str, Any]]:
         "ascending": "false",
         "closed": "false",
     }
-    r = requests.get(url, params=params, timeout=30)
+    r = send_with_retry(GAMMA_BUCKET, "GET", url, params=params, timeout=30)
     r.raise_for_status()
-    data = r.json()
+    data = orjson.loads(r.content)
     if not isinstance(data, list):
         raise ValueError("Respuesta inesperada de Gamma /markets")
     return data
@@ -58,11 +151,7 @@ def pick_top_markets(raw_markets: List[Dict[str, Any]], top_n: int) -> List[Dict
         if m.get("active") is not True:
             continue
 
-        clob_token_ids = safe_json_loads(m.get("clobTokenIds"))
-        if isinstance(clob_token_ids, list):
-            token_ids = [str(x) for x in clob_token_ids]
-        else:
-            token_ids = []
+        token_ids = parse_clob_token_ids(m.get("clobTokenIds"))
 
         if not token_ids:
             continue
@@ -87,24 +176,23 @@ def pick_top_markets(raw_markets: List[Dict[str, Any]], top_n: int) -> List[Dict
     return cleaned[:top_n]
 
 
-def maybe_refresh_tokens(max_age_hours: int = 24) -> List[str]:
+def maybe_refresh_tokens(max_age_hours: int = 24, pretty: bool = False) -> List[str]:
     OUT_DIR.mkdir(parents=True, exist_ok=True)
 
     if TOKENS_FILE.exists():
         age_s = time.time() - TOKENS_FILE.stat().st_mtime
         if age_s < max_age_hours * 3600:
-            return json.loads(TOKENS_FILE.read_text(encoding="utf-8"))
+            return orjson.loads(TOKENS_FILE.read_bytes())
 
     raw = fetch_markets(limit=300, offset=0)
     markets = pick_top_markets(raw, TOP_MARKETS)
 
-    token_ids: List[str] = []
-    for m in markets:
-        token_ids.extend(m["clobTokenIds"])
-    token_ids = sorted(set(token_ids))
+    # sin duplicados y en orden de volumen (el primer batch de /books lleva el top)
+    token_ids: List[str] = list(dict.fromkeys(tid for m in markets for tid in m["clobTokenIds"]))
 
-    MARKETS_FILE.write_text(json.dumps(markets, ensure_ascii=False, indent=2), encoding="utf-8")
-    TOKENS_FILE.write_text(json.dumps(token_ids, ensure_ascii=False, indent=2), encoding="utf-8")
+    json_opt = orjson.OPT_INDENT_2 if pretty else 0
+    MARKETS_FILE.write_bytes(orjson.dumps(markets, option=json_opt))
+    TOKENS_FILE.write_bytes(orjson.dumps(token_ids, option=json_opt))
 
     return token_ids
 
@@ -115,27 +203,42 @@ def chunked(items: List[str], size: int) -> List[List[str]]:
 
 def fetch_books_bulk(token_ids: List[str]) -> List[Dict[str, Any]]:
     url = f"{CLOB_BASE}/books"
+    batches = chunked(token_ids, BOOKS_BATCH)
     out: List[Dict[str, Any]] = []
-    for batch in chunked(token_ids, BOOKS_BATCH):
+    failed = 0
+    for i, batch in enumerate(batches):
         payload = [{"token_id": tid} for tid in batch]
-        r = requests.post(url, json=payload, timeout=30)
-        r.raise_for_status()
-        data = r.json()
+        try:
+            r = send_with_retry(
+                CLOB_BUCKET, "POST", url,
+                data=orjson.dumps(payload), headers={"Content-Type": "application/json"}, timeout=30,
+            )
+            r.raise_for_status()
+            data = orjson.loads(r.content)
+        except (requests.RequestException, orjson.JSONDecodeError) as e:
+            failed += 1
+            print(f"[WARN] /books falló para el batch {i} ({len(batch)} tokens): {e}")
+            continue
         if isinstance(data, list):
             out.extend(data)
         else:
             out.append(data)
-        time.sleep(SLEEP_BETWEEN_POSTS)
+    if batches and failed == len(batches):
+        raise RuntimeError("Todos los batches de /books fallaron.")
     return out
 
 
 def append_jsonl(path: Path, obj: Dict[str, Any]) -> None:
-    with path.open("a", encoding="utf-8") as f:
-        f.write(json.dumps(obj, ensure_ascii=False) + "\n")
+    with path.open("ab") as f:
+        f.write(orjson.dumps(obj) + b"\n")
 
 
 def main():
-    token_ids = maybe_refresh_tokens(max_age_hours=24)
+    parser = argparse.ArgumentParser(description="Snapshot de orderbooks de Polymarket al log JSONL diario.")
+    parser.add_argument("--pretty", action="store_true", help="markets_top/tokens_top indentados (legibles) en vez de compactos")
+    args = parser.parse_args()
+
+    token_ids = maybe_refresh_tokens(max_age_hours=24, pretty=args.pretty)
 
     books = fetch_books_bulk(token_ids)
     snap = {
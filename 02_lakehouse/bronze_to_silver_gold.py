@@ -1,22 +1,58 @@
-import csv
-import json
 from dataclasses import dataclass
 from datetime import datetime
 from pathlib import Path
-from typing import Any, Dict, List, Optional, Tuple
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+import ijson
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+from numba import njit
 
 
 # ====== Config ======
 TOP_LEVELS_PER_SIDE = 20         # cuántos niveles guardamos en Silver
 DEPTH_BAND = 0.01                # "1 punto" alrededor del midpoint
 BUDGETS = [10, 50, 200]          # presupuesto (USDC aprox.) para slippage buy
+SILVER_ROW_GROUP_BOOKS = 200     # books por row group de Silver (acota la RAM)
 # ====================
 
-
-@dataclass
-class Level:
-    price: float
-    size: float
+SILVER_SCHEMA = pa.schema([
+    ("snapshot_ts", pa.string()),
+    ("token_id", pa.string()),
+    ("side", pa.string()),
+    ("level", pa.int32()),
+    ("price", pa.float64()),
+    ("size", pa.float64()),
+])
+
+GOLD_SCHEMA = pa.schema([
+    ("snapshot_ts", pa.string()),
+    ("token_id", pa.string()),
+    ("best_bid", pa.float64()),
+    ("best_ask", pa.float64()),
+    ("mid", pa.float64()),
+    ("spread", pa.float64()),
+    ("depth_1pt", pa.float64()),
+    ("slippage_buy_10", pa.float64()),
+    ("slippage_buy_50", pa.float64()),
+    ("slippage_buy_200", pa.float64()),
+    ("score", pa.float64()),
+])
+
+
+@dataclass(slots=True)
+class Book:
+    """
+    Orderbook de un token en formato SoA (un array por campo y lado),
+    en el orden en que llega de la API (sin ordenar).
+    """
+    token_id: str
+    snapshot_ts: str
+    bid_price: np.ndarray
+    bid_size: np.ndarray
+    ask_price: np.ndarray
+    ask_size: np.ndarray
 
 
 def find_latest_snapshot(base: Path) -> Path:
@@ -43,26 +79,150 @@ def find_latest_snapshot(base: Path) -> Path:
     return sorted(candidates)[-1]
 
 
-def load_orderbooks(snapshot_dir: Path) -> List[Dict[str, Any]]:
+def iter_orderbooks(snapshot_dir: Path) -> Iterator[Dict[str, Any]]:
+    """
+    Recorre orderbooks.json en streaming con ijson (un book cada vez), así
+    la RAM queda acotada por un book y no por el fichero entero. La etapa
+    está dominada por I/O, así que procesar book a book no la ralentiza.
+    """
     p = snapshot_dir / "books" / "orderbooks.json"
     if not p.exists():
         raise FileNotFoundError(f"No encuentro {p}.")
-    return json.loads(p.read_text(encoding="utf-8"))
+    with p.open("rb") as f:
+        yield from ijson.items(f, "item", use_float=True)
 
 
-def parse_levels(side_levels: List[Dict[str, Any]]) -> List[Level]:
-    out: List[Level] = []
+def parse_levels(side_levels: Optional[List[Dict[str, Any]]]) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Devuelve (prices, sizes) como arrays float64; ignora niveles mal formados.
+    """
+    prices: List[float] = []
+    sizes: List[float] = []
     for x in side_levels or []:
         try:
-            out.append(Level(price=float(x["price"]), size=float(x["size"])))
+            price = float(x["price"])
+            size = float(x["size"])
         except Exception:
             continue
-    return out
+        prices.append(price)
+        sizes.append(size)
+    return np.array(prices, dtype=np.float64), np.array(sizes, dtype=np.float64)
+
+
+def parse_book(ob: Dict[str, Any]) -> Book:
+    bid_p, bid_s = parse_levels(ob.get("bids", []))
+    ask_p, ask_s = parse_levels(ob.get("asks", []))
+    return Book(
+        token_id=str(ob.get("asset_id") or ob.get("token_id") or ""),
+        snapshot_ts=str(ob.get("timestamp") or ""),
+        bid_price=bid_p,
+        bid_size=bid_s,
+        ask_price=ask_p,
+        ask_size=ask_s,
+    )
+
+
+def iter_books_parquet(p: Path) -> Iterator[Book]:
+    """
+    Lee orderbooks.parquet (una fila por nivel, agrupadas por book) y corta
+    por cambios de book_idx, sin pasar por JSON ni por objetos por nivel.
+    Las filas con side a null son books sin niveles: salen como Book vacío.
+    """
+    table = pq.read_table(p, read_dictionary=["snapshot_ts", "token_id", "side"])
+    if table.num_rows == 0:
+        return
+    table = table.unify_dictionaries().combine_chunks()
+
+    token_col = table.column("token_id").chunk(0)
+    ts_col = table.column("snapshot_ts").chunk(0)
+    side_col = table.column("side").chunk(0)
+    token_codes = token_col.indices.to_numpy()
+    ts_codes = ts_col.indices.to_numpy()
+    side_names = side_col.dictionary.to_pylist()
+    side_codes = side_col.indices.fill_null(-1).to_numpy()
+    is_bid = side_codes == (side_names.index("bid") if "bid" in side_names else -2)
+    is_ask = side_codes == (side_names.index("ask") if "ask" in side_names else -2)
+    prices = table.column("price").to_numpy()
+    sizes = table.column("size").to_numpy()
+    tokens = token_col.dictionary.to_pylist()
+    timestamps = ts_col.dictionary.to_pylist()
+
+    book_codes = table.column("book_idx").to_numpy()
+
+    starts = np.concatenate(([0], np.flatnonzero(np.diff(book_codes)) + 1))
+    ends = np.append(starts[1:], table.num_rows)
+    for start, end in zip(starts.tolist(), ends.tolist()):
+        bid = is_bid[start:end]
+        ask = is_ask[start:end]
+        p_book = prices[start:end]
+        s_book = sizes[start:end]
+        yield Book(
+            token_id=tokens[token_codes[start]],
+            snapshot_ts=timestamps[ts_codes[start]],
+            bid_price=p_book[bid],
+            bid_size=s_book[bid],
+            ask_price=p_book[ask],
+            ask_size=s_book[ask],
+        )
+
+
+def iter_books(snapshot_dir: Path) -> Iterator[Book]:
+    """
+    Books del snapshot: orderbooks.parquet si existe; si no (snapshots
+    antiguos), orderbooks.json en streaming.
+    """
+    p = snapshot_dir / "books" / "orderbooks.parquet"
+    if p.exists():
+        yield from iter_books_parquet(p)
+    else:
+        for ob in iter_orderbooks(snapshot_dir):
+            yield parse_book(ob)
+
+
+def best_levels(prices: np.ndarray, sizes: np.ndarray, k: int, descending: bool = False) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Los k mejores niveles de un lado, ordenados mejor precio primero.
+    argpartition (O(N)) + ordenar solo esos k, en vez de ordenar el lado entero.
+    A igual precio se respeta el orden original.
+    """
+    n = prices.size
+    if k <= 0 or n == 0:
+        return prices[:0], sizes[:0]
+    keys = -prices if descending else prices
+    if k < n:
+        # todo lo mejor que el k-ésimo + los primeros empates con él
+        kth = np.partition(keys, k - 1)[k - 1]
+        better = np.flatnonzero(keys < kth)
+        ties = np.flatnonzero(keys == kth)[:k - better.size]
+        idx = np.concatenate((better, ties))
+    else:
+        idx = np.arange(n)
+    idx = idx[np.argsort(keys[idx], kind="stable")]
+    return prices[idx], sizes[idx]
+
+
+def asks_for_fill(
+    book: Book, ask_p_top: np.ndarray, ask_s_top: np.ndarray, budget: float,
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Asks ordenados suficientes para simular una compra de `budget`: si los top
+    niveles ya cubren el presupuesto bastan; si no, se ordena el lado entero.
+    """
+    if ask_p_top.size == book.ask_price.size:
+        return ask_p_top, ask_s_top
+    valid = ask_p_top > 0
+    if float((ask_p_top[valid] * ask_s_top[valid]).sum()) >= budget:
+        return ask_p_top, ask_s_top
+    return best_levels(book.ask_price, book.ask_size, book.ask_price.size)
 
 
-def best_bid_ask(bids: List[Level], asks: List[Level]) -> Tuple[Optional[float], Optional[float]]:
-    bb = max((l.price for l in bids), default=None)
-    ba = min((l.price for l in asks), default=None)
+def best_bid_ask(bid_p_top: np.ndarray, ask_p_top: np.ndarray) -> Tuple[Optional[float], Optional[float]]:
+    """
+    A partir de los top levels ya ordenados (mejor primero): el mejor es el primero,
+    sin recorrer otra vez el lado entero.
+    """
+    bb = float(bid_p_top[0]) if bid_p_top.size else None
+    ba = float(ask_p_top[0]) if ask_p_top.size else None
     return bb, ba
 
 
@@ -76,45 +236,40 @@ def midpoint(best_bid: Optional[float], best_ask: Optional[float]) -> Optional[f
     return (best_bid + best_ask) / 2.0
 
 
-def calc_depth(bids: List[Level], asks: List[Level], mid: Optional[float], band: float) -> Optional[float]:
+def calc_depth(book: Book, mid: Optional[float], band: float) -> Optional[float]:
     if mid is None:
         return None
     lo = mid - band
     hi = mid + band
-    bid_depth = sum(l.size for l in bids if l.price >= lo)
-    ask_depth = sum(l.size for l in asks if l.price <= hi)
-    return bid_depth + ask_depth
+    bid_depth = book.bid_size[book.bid_price >= lo].sum()
+    ask_depth = book.ask_size[book.ask_price <= hi].sum()
+    return float(bid_depth + ask_depth)
 
 
-def buy_avg_fill_price(asks: List[Level], budget: float) -> Optional[float]:
+@njit(cache=True)
+def buy_avg_fill_price_nb(ask_prices: np.ndarray, ask_sizes: np.ndarray, budget: float) -> float:
     """
-    Simula compra con presupuesto en $:
-      - recorre asks (mejor precio primero)
-      - consume shares hasta agotar presupuesto
-    Devuelve precio medio pagado ($/share), o None si no puede rellenar nada.
+    Kernel compilado de buy_avg_fill_price (asks ya ordenados ascendente).
+    Devuelve NaN si no puede rellenar nada.
     """
-    if budget <= 0 or not asks:
-        return None
-
-    asks_sorted = sorted(asks, key=lambda l: l.price)
     remaining = budget
     total_cost = 0.0
     total_shares = 0.0
 
-    for lvl in asks_sorted:
-        if lvl.price <= 0:
+    for i in range(ask_prices.shape[0]):
+        price = ask_prices[i]
+        if price <= 0:
             continue
-        lvl_cost_full = lvl.price * lvl.size
+        lvl_cost_full = price * ask_sizes[i]
         if remaining >= lvl_cost_full:
             # cogemos todo
             total_cost += lvl_cost_full
-            total_shares += lvl.size
+            total_shares += ask_sizes[i]
             remaining -= lvl_cost_full
         else:
             # cogemos parcial
-            partial_shares = remaining / lvl.price
             total_cost += remaining
-            total_shares += partial_shares
+            total_shares += remaining / price
             remaining = 0.0
             break
 
@@ -122,14 +277,55 @@ def buy_avg_fill_price(asks: List[Level], budget: float) -> Optional[float]:
             break
 
     if total_shares <= 1e-12:
-        return None
+        return np.nan
     return total_cost / total_shares
 
 
+def buy_avg_fill_price(ask_prices: np.ndarray, ask_sizes: np.ndarray, budget: float) -> Optional[float]:
+    """
+    Simula compra con presupuesto en $:
+      - recorre asks (ya ordenados por precio ascendente: mejor precio primero)
+      - consume shares hasta agotar presupuesto
+    Devuelve precio medio pagado ($/share), o None si no puede rellenar nada.
+    """
+    if budget <= 0 or ask_prices.size == 0:
+        return None
+    avg = buy_avg_fill_price_nb(ask_prices, ask_sizes, float(budget))
+    return None if np.isnan(avg) else float(avg)
+
+
+# compila el kernel al importar (con cache=True solo se paga la primera vez)
+buy_avg_fill_price_nb(np.array([0.5]), np.array([1.0]), 1.0)
+
+
 def safe_float(x: Optional[float]) -> str:
     return "" if x is None else f"{x:.6f}"
 
 
+def append_levels(cols: Dict[str, list], book: Book, side: str, prices: np.ndarray, sizes: np.ndarray) -> None:
+    """
+    Añade los niveles (ya ordenados) de un lado del book a las columnas de Silver.
+    """
+    n = int(prices.size)
+    cols["snapshot_ts"].extend([book.snapshot_ts] * n)
+    cols["token_id"].extend([book.token_id] * n)
+    cols["side"].extend([side] * n)
+    cols["level"].extend(range(1, n + 1))
+    cols["price"].extend(prices.tolist())
+    cols["size"].extend(sizes.tolist())
+
+
+def flush_silver(writer: pq.ParquetWriter, cols: Dict[str, list]) -> None:
+    """
+    Escribe lo acumulado como un row group y vacía las columnas.
+    """
+    if not cols["token_id"]:
+        return
+    writer.write_table(pa.table(cols, schema=SILVER_SCHEMA))
+    for values in cols.values():
+        values.clear()
+
+
 def main():
     bronze_base = Path("data/bronze/polymarket")
     snapshot_dir = find_latest_snapshot(bronze_base)
@@ -138,50 +334,48 @@ def main():
     tag = snapshot_dir.parent.name + "_" + snapshot_dir.name  # YYYY-MM-DD_HHMMSS
     print(f"[INFO] Usando snapshot: {snapshot_dir}")
 
-    orderbooks = load_orderbooks(snapshot_dir)
-
     # outputs
     silver_dir = Path("data/silver")
     gold_dir = Path("data/gold")
     silver_dir.mkdir(parents=True, exist_ok=True)
     gold_dir.mkdir(parents=True, exist_ok=True)
 
-    silver_path = silver_dir / f"orderbook_levels_{tag}.csv"
-    gold_path = gold_dir / f"metrics_{tag}.csv"
+    silver_path = silver_dir / f"orderbook_levels_{tag}.parquet"
+    gold_path = gold_dir / f"metrics_{tag}.parquet"
 
-    # SILVER: niveles
-    with silver_path.open("w", newline="", encoding="utf-8") as f:
-        w = csv.writer(f)
-        w.writerow(["snapshot_ts", "token_id", "side", "level", "price", "size"])
+    # SILVER: niveles (por row groups, según se leen los books)
+    # GOLD: métricas por token (una tupla por book; se trasponen al final)
+    silver_cols: Dict[str, list] = {name: [] for name in SILVER_SCHEMA.names}
+    gold_rows: List[tuple] = []
 
-        # GOLD: métricas por token
-        gold_rows = []
+    # locales en vez de globales dentro del bucle por book
+    top_levels = best_levels
+    add_levels = append_levels
+    fill = buy_avg_fill_price
+    add_gold = gold_rows.append
+    TOP = TOP_LEVELS_PER_SIDE
+    max_budget = max(BUDGETS)
 
-        for ob in orderbooks:
-            token_id = str(ob.get("asset_id") or ob.get("token_id") or "")
-            snap_ts = str(ob.get("timestamp") or "")
-
-            bids = parse_levels(ob.get("bids", []))
-            asks = parse_levels(ob.get("asks", []))
+    with pq.ParquetWriter(silver_path, SILVER_SCHEMA, compression="zstd") as silver_writer:
+        for n_books, book in enumerate(iter_books(snapshot_dir), start=1):
+            # una sola selección por lado: de ella salen Silver, best bid/ask y el slippage
+            bid_p_top, bid_s_top = top_levels(book.bid_price, book.bid_size, TOP, descending=True)
+            ask_p_top, ask_s_top = top_levels(book.ask_price, book.ask_size, TOP)
 
             # guardar top levels
-            bids_sorted = sorted(bids, key=lambda l: l.price, reverse=True)[:TOP_LEVELS_PER_SIDE]
-            asks_sorted = sorted(asks, key=lambda l: l.price)[:TOP_LEVELS_PER_SIDE]
-
-            for i, lvl in enumerate(bids_sorted, start=1):
-                w.writerow([snap_ts, token_id, "bid", i, lvl.price, lvl.size])
-            for i, lvl in enumerate(asks_sorted, start=1):
-                w.writerow([snap_ts, token_id, "ask", i, lvl.price, lvl.size])
+            add_levels(silver_cols, book, "bid", bid_p_top, bid_s_top)
+            add_levels(silver_cols, book, "ask", ask_p_top, ask_s_top)
 
-            bb, ba = best_bid_ask(bids, asks)
+            bb, ba = best_bid_ask(bid_p_top, ask_p_top)
             mid = midpoint(bb, ba)
             spread = None if (bb is None or ba is None) else (ba - bb)
-            depth = calc_depth(bids, asks, mid, DEPTH_BAND)
+            depth = calc_depth(book, mid, DEPTH_BAND)
 
-            # slippages (buy) por presupuesto
-            avg10 = buy_avg_fill_price(asks, 10)
-            avg50 = buy_avg_fill_price(asks, 50)
-            avg200 = buy_avg_fill_price(asks, 200)
+            # slippages (buy) por presupuesto; normalmente bastan los top asks
+            ask_p_fill, ask_s_fill = asks_for_fill(book, ask_p_top, ask_s_top, max_budget)
+            avg10 = fill(ask_p_fill, ask_s_fill, 10)
+            avg50 = fill(ask_p_fill, ask_s_fill, 50)
+            avg200 = fill(ask_p_fill, ask_s_fill, 200)
 
             # baseline: midpoint si existe, si no mejor ask
             baseline = mid if mid is not None else ba
@@ -195,46 +389,21 @@ def main():
             if depth is not None and spread is not None and sl50 is not None:
                 score = (depth / 1000.0) - (spread * 3.0) - (sl50 * 4.0)
 
-            gold_rows.append({
-                "snapshot_ts": snap_ts,
-                "token_id": token_id,
-                "best_bid": bb,
-                "best_ask": ba,
-                "mid": mid,
-                "spread": spread,
-                "depth_1pt": depth,
-                "slippage_buy_10": sl10,
-                "slippage_buy_50": sl50,
-                "slippage_buy_200": sl200,
-                "score": score,
-            })
-
-    # escribir GOLD
-    with gold_path.open("w", newline="", encoding="utf-8") as f:
-        w = csv.writer(f)
-        w.writerow([
-            "snapshot_ts", "token_id",
-            "best_bid", "best_ask", "mid", "spread",
-            "depth_1pt",
-            "slippage_buy_10", "slippage_buy_50", "slippage_buy_200",
-            "score"
-        ])
-        for r in gold_rows:
-            w.writerow([
-                r["snapshot_ts"], r["token_id"],
-                "" if r["best_bid"] is None else r["best_bid"],
-                "" if r["best_ask"] is None else r["best_ask"],
-                "" if r["mid"] is None else r["mid"],
-                "" if r["spread"] is None else r["spread"],
-                "" if r["depth_1pt"] is None else r["depth_1pt"],
-                "" if r["slippage_buy_10"] is None else r["slippage_buy_10"],
-                "" if r["slippage_buy_50"] is None else r["slippage_buy_50"],
-                "" if r["slippage_buy_200"] is None else r["slippage_buy_200"],
-                "" if r["score"] is None else r["score"],
-            ])
-
-    print(f"[OK] Silver CSV: {silver_path}")
-    print(f"[OK] Gold  CSV: {gold_path}")
+            # mismo orden que GOLD_SCHEMA
+            add_gold((book.snapshot_ts, book.token_id, bb, ba, mid, spread, depth, sl10, sl50, sl200, score))
+
+            if n_books % SILVER_ROW_GROUP_BOOKS == 0:
+                flush_silver(silver_writer, silver_cols)
+
+        flush_silver(silver_writer, silver_cols)
+
+    # escribir GOLD (Parquet, zstd; los None quedan como null)
+    gold_cols = list(zip(*gold_rows)) or [[] for _ in GOLD_SCHEMA.names]
+    gold_table = pa.table(dict(zip(GOLD_SCHEMA.names, gold_cols)), schema=GOLD_SCHEMA)
+    pq.write_table(gold_table, gold_path, compression="zstd")
+
+    print(f"[OK] Silver Parquet: {silver_path}")
+    print(f"[OK] Gold  Parquet: {gold_path}")
     print("[DONE] Paso 4 completado.")
 
 